@@ -30,20 +30,24 @@ import argparse
 import contextlib
 import docker
 import io
-import json
 import os
 import posixpath
-import uuid
 import shlex
+import stat
 import sys
 import tarfile
+import threading
 
-if not hasattr(shlex, 'quote'):
-  import pipes
-  shlex.quote = pipes.quote
+# Buffer size for reading files and writing archives in #copy().
+_COPY_BUFSIZE = 1 << 20
 
-client = docker.from_env()
-client.ping()
+# Keyword arguments of #run() that #dockertools.container_exec_stream() handles.
+_EXEC_STREAM_KWARGS = frozenset(['workdir', 'user', 'environment', 'privileged'])
+
+# Path separators that make #buildtime_volume() treat a name as a path.
+_seps = (os.sep, '/') if os.name == 'nt' else (os.sep,)
+
+_client = None
 
 parser = argparse.ArgumentParser()
 add_argument = parser.add_argument
@@ -59,6 +63,27 @@ _expose = []
 _volumes = []
 
 
+def _get_client():
+  """
+  Returns the Docker client, connecting to the daemon on first use instead
+  of when the module is imported.
+  """
+
+  global _client
+  if _client is None:
+    client = docker.from_env()
+    client.ping()
+    _client = client
+  return _client
+
+
+def __getattr__(name):
+  # Keep the former module-level `client` accessible.
+  if name == 'client':
+    return _get_client()
+  raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
 def error(message, code=1):
   print(message, file=sys.stderr)
   sys.exit(code)
@@ -83,9 +108,9 @@ def new(image, command=['sleep', '999999999'], **kwargs):
   kwargs['volumes'] = utils.merge_dictionary(
     buildtime_volumes, kwargs.get('volumes', {}))
 
-  name = 'dib-temp-' + str(uuid.uuid4())[:8]
+  name = 'dib-temp-' + os.urandom(4).hex()
   try:
-    container = client.containers.run(image, command, name=name,
+    container = _get_client().containers.run(image, command, name=name,
       auto_remove=True, detach=True, **kwargs)
     yield
   finally:
@@ -106,14 +131,16 @@ def new(image, command=['sleep', '999999999'], **kwargs):
 
 def run(cmd, **kwargs):
   """
-  Uses #docker.Container.exec_run() to execute a command in the current
-  container.
+  Executes a command in the current container. Keyword arguments are passed
+  to #dockertools.container_exec(). The common case of only `workdir`,
+  `user`, `environment` and `privileged` uses the faster
+  #dockertools.container_exec_stream().
   """
 
   if not container:
     raise RuntimeError('no current container')
 
-  cmd_str = cmd if isinstance(cmd, str) else ' '.join(map(shlex.quote, cmd))
+  cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
   print('RUN', cmd_str)
   print()
 
@@ -123,7 +150,10 @@ def run(cmd, **kwargs):
   if _workdir and 'workdir' not in kwargs:
     kwargs['workdir'] = _workdir
 
-  result = dockertools.container_exec(container, cmd, stream=True, **kwargs)
+  if _EXEC_STREAM_KWARGS.issuperset(kwargs):
+    result = dockertools.container_exec_stream(container, cmd, **kwargs)
+  else:
+    result = dockertools.container_exec(container, cmd, stream=True, **kwargs)
   res = result.communicate(line_prefix=b'    ')
   print()
 
@@ -131,6 +161,21 @@ def run(cmd, **kwargs):
     error('ERROR exit code {!r}'.format(res))
 
 
+def run_many(cmds, **kwargs):
+  """
+  Executes all commands in the list *cmds* with a single #run(). The commands
+  are joined into a bash script with `set -ex`, so every command is echoed
+  before it runs and the first failing command aborts the script. Use this
+  instead of multiple #run() calls to save the round-trips to the Docker
+  daemon for every command.
+  """
+
+  lines = ['set -ex']
+  for cmd in cmds:
+    lines.append(cmd if isinstance(cmd, str) else shlex.join(cmd))
+  run('\n'.join(lines), **kwargs)
+
+
 def buildtime_volume(host_path, container_path, mode='rw'):
   """
   Add a volume to be mounted at build time. This needs to be called before
@@ -141,13 +186,9 @@ def buildtime_volume(host_path, container_path, mode='rw'):
   if container:
     raise RuntimeError('buildtime_volume() can not be used from inside a build context')
 
-  seps = [path.sep]
-  if os.name == 'nt':
-    seps.append('/')
-
-  if not path.isabs(host_path) and (host_path.startswith(path.curdir) or
-      host_path.startswith(path.pardir) or any(x in host_path for x in seps)):
-    host_path = path.abs(host_path)
+  if not os.path.isabs(host_path) and (host_path.startswith(path.curdir) or
+      host_path.startswith(path.pardir) or any(x in host_path for x in _seps)):
+    host_path = os.path.abspath(host_path)
 
   buildtime_volumes[host_path] = {'bind': container_path, 'mode': mode}
 
@@ -251,15 +292,20 @@ def commit(repository=None, tag=None, author=None, message=None, conf=None):
   else:
     repository, tag = None, None
 
-  changes = []
+  # Pass the configuration as structured fields rather than Dockerfile
+  # instructions, which the daemon would have to parse. EXPOSE and VOLUME
+  # stay instructions so that their full syntax (port ranges, JSON arrays)
+  # is still supported.
+  conf = dict(conf or {})
   if _cmd is not None:
-    changes.append('CMD ' + json.dumps(_cmd))
+    conf.setdefault('Cmd', _cmd)
   if _entrypoint is not None:
-    changes.append('ENTRYPOINT ' + json.dumps(_entrypoint))
+    conf.setdefault('Entrypoint', _entrypoint)
   if _user is not None:
-    changes.append('USER ' + _user)
+    conf.setdefault('User', _user)
   if _workdir is not None:
-    changes.append('WORKDIR ' + json.dumps(_workdir))
+    conf.setdefault('WorkingDir', _workdir)
+  changes = []
   for port in _expose:
     changes.append('EXPOSE ' + port)
   for vol in _volumes:
@@ -269,26 +315,117 @@ def commit(repository=None, tag=None, author=None, message=None, conf=None):
     author=author, changes=changes, conf=conf)
 
 
+class _CrlfReader(object):
+  """
+  Wraps a binary file object and converts CRLF line endings to LF while
+  reading, without loading the whole file into memory. A trailing CR at a
+  chunk boundary is held back until the next chunk shows whether it starts
+  with LF. Like a regular file, #read() only returns less than *n* bytes
+  at the end of the file, which is what #tarfile expects.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    self.tail = b''
+    self.buffer = bytearray()
+    self.eof = False
+
+  def read(self, n):
+    while len(self.buffer) < n and not self.eof:
+      data = self.fp.read(max(n, _COPY_BUFSIZE))
+      if data:
+        data = self.tail + data
+        self.tail = b''
+        if data.endswith(b'\r'):
+          data, self.tail = data[:-1], b'\r'
+      else:
+        data, self.tail = self.tail, b''
+        self.eof = True
+      self.buffer += data.replace(b'\r\n', b'\n')
+    result = bytes(self.buffer[:n])
+    del self.buffer[:n]
+    return result
+
+
+class _ArchiveAborted(Exception):
+  """
+  Raised from the request body in #copy() to abort the upload when building
+  the archive failed.
+  """
+
+
+def _write_archive(fileobj, src, crlf_to_lf, chmod, st=None):
+  with utils.TarFile.open(fileobj=fileobj, mode='w',
+                          copybufsize=_COPY_BUFSIZE) as tar:
+    if crlf_to_lf:
+      with open(src, 'rb', _COPY_BUFSIZE) as fp:
+        reader = _CrlfReader(fp)
+        size = sum(map(len, iter(lambda: reader.read(_COPY_BUFSIZE), b'')))
+        fp.seek(0)
+        tf = tarfile.TarInfo(path.base(src))
+        tf.mode = path.chmod_update(st.st_mode, chmod)
+        tf.size = size
+        tar.addfile(tf, _CrlfReader(fp))
+    else:
+      tar.add(src, path.base(src), recursive=True)
+
+
 def copy(src, dst, crlf_to_lf=False, chmod=''):
   if _workdir:
     dst = posixpath.normpath(posixpath.join(_workdir, dst))
     print()
     print('@@@', dst)
     print()
-  buffer = io.BytesIO()
-  with tarfile.open(fileobj=buffer, mode='w') as tar:
-    if crlf_to_lf and not path.isfile(src):
+  st = None
+  if crlf_to_lf:
+    st = os.stat(src)
+    if not stat.S_ISREG(st.st_mode):
       raise RuntimeError('crlf_to_lf=True, but "{}" is not a file'.format(src))
-    if crlf_to_lf:
-      with open(src, 'rb') as fp:
-        content = fp.read().replace(b'\r\n', b'\n')
-      tf = tarfile.TarInfo(path.base(src))
-      tf.mode = path.chmod_update(os.stat(src).st_mode, chmod)
-      tf.size = len(content)
-      tar.addfile(tf, io.BytesIO(content))
-    else:
-      tar.add(src, path.base(src), recursive=True)
-  if not container.put_archive(dst, buffer.getvalue()):
+
+  # Uploading to a remote daemon is bound by the network, compressing the
+  # archive pays off there.
+  compress = dockertools.is_remote(container.client)
+
+  # Build the archive in a background thread and upload it while it is
+  # being written, instead of one step after the other.
+  read_fd, write_fd = os.pipe()
+  errors = []
+  def produce():
+    try:
+      with utils.PipeWriter(io.FileIO(write_fd, 'w'), _COPY_BUFSIZE) as fp:
+        if compress:
+          with utils.gzip_writer(fp) as gz:
+            _write_archive(gz, src, crlf_to_lf, chmod, st)
+        else:
+          _write_archive(fp, src, crlf_to_lf, chmod, st)
+    except BaseException as exc:
+      errors.append(exc)
+
+  def upload(fp):
+    yield from iter(lambda: fp.read(_COPY_BUFSIZE), b'')
+    # The pipe is also closed when the producer fails. Abort the request
+    # before it is completed in that case, otherwise the daemon would
+    # accept the partial archive.
+    thread.join()
+    if errors:
+      raise _ArchiveAborted()
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    with open(read_fd, 'rb', _COPY_BUFSIZE) as fp:
+      result = container.put_archive(dst, upload(fp))
+  except _ArchiveAborted:
+    raise errors[0] from None
+  except BaseException as exc:
+    # Closing the read end above makes the producer fail with a broken pipe
+    # if the upload stopped early, so this never blocks.
+    thread.join()
+    if errors and not isinstance(errors[0], BrokenPipeError):
+      raise exc from errors[0]
+    raise
+  if not result:
     raise RuntimeError('put_archive() failed')
 
 
@@ -311,12 +448,27 @@ class apt:
     run(['apt-get', 'update'])
 
   @staticmethod
-  def install(*packages, yes=True):
+  def _install_cmd(packages, yes):
     cmd = ['apt-get', 'install']
     if yes:
       cmd += ['-y']
     cmd += packages
-    run(cmd)
+    return cmd
+
+  @staticmethod
+  def install(*packages, yes=True):
+    run(apt._install_cmd(packages, yes))
+
+  @staticmethod
+  def setup(*packages, yes=True):
+    """
+    Updates the package lists, installs *packages* and cleans up again in a
+    single #run(). This is the preferred way to install packages as it needs
+    one exec instead of three and lets APT plan a single transaction.
+    """
+
+    run('apt-get update && {} && rm -rf /var/lib/apt/lists/*'.format(
+      shlex.join(apt._install_cmd(packages, yes))))
 
 
 class apk:
@@ -335,3 +487,13 @@ class apk:
   @staticmethod
   def add(*packages):
     run(['apk', 'add'] + list(packages))
+
+  @staticmethod
+  def setup(*packages):
+    """
+    Adds *packages* with `--no-cache`, which fetches a fresh package index
+    and does not leave it in the image, in a single #run(). This is the
+    preferred way to install packages.
+    """
+
+    run(['apk', 'add', '--no-cache'] + list(packages))
@@ -23,8 +23,23 @@
 Stuff that the Python docker module can't do.
 """
 
+import re
+import struct
 import sys
 
+# Matches ANSI SGR (color) and erase-in-line escape sequences.
+_ANSI = re.compile(rb'\x1b\[[0-9;]*[mK]')
+
+
+def is_remote(client):
+  """
+  Returns #True if the Docker *client* talks to the daemon over the network
+  rather than a local UNIX socket or named pipe.
+  """
+
+  return client.api.base_url not in ('http+docker://localhost',
+    'http+docker://localunixsocket', 'http+docker://localnpipe')
+
 
 def container_exec(container, cmd, stdout=True, stderr=True, stdin=False,
                    tty=False, privileged=False, user='', detach=False,
@@ -45,6 +60,82 @@ def container_exec(container, cmd, stdout=True, stderr=True, stdin=False,
   return ContainerExec(container.client, exec_id, output)
 
 
+def container_exec_stream(container, cmd, *, workdir=None, user='',
+                          environment=None, privileged=False):
+  """
+  A specialized #container_exec() for the common case of running a command
+  without TTY and stdin and reading its stdout and stderr. The output of
+  the returned #ContainerExec is read from the raw socket with
+  #iter_frames(), so the command may be silent for longer than the client
+  timeout.
+  """
+
+  api = container.client.api
+  exec_id = api.exec_create(container.id, cmd, privileged=privileged,
+    user=user, environment=environment, workdir=workdir)['Id']
+  sock = api.exec_start(exec_id, socket=True)
+  return ContainerExec(container.client, exec_id, iter_frames(sock))
+
+
+def _disable_timeout(sock):
+  # Like docker-py's APIClient._disable_socket_timeout(). The socket still
+  # has the client's timeout, but an exec may be silent for longer than that.
+  for s in (sock, getattr(sock, '_sock', None)):
+    if not hasattr(s, 'settimeout'):
+      continue
+    timeout = s.gettimeout() if hasattr(s, 'gettimeout') else -1
+    if timeout is None or timeout == 0.0:
+      continue
+    s.settimeout(None)
+
+
+def _recv_into(sock, view):
+  if hasattr(sock, 'recv_into'):
+    return sock.recv_into(view)
+  if hasattr(sock, 'readinto'):
+    return sock.readinto(view)
+  data = sock.recv(len(view))
+  view[:len(data)] = data
+  return len(data)
+
+
+def _recv_exactly(sock, view):
+  offset = 0
+  while offset < len(view):
+    n = _recv_into(sock, view[offset:])
+    if not n:
+      break
+    offset += n
+  return offset
+
+
+def iter_frames(sock, bufsize=1 << 20):
+  """
+  Reads the multiplexed stdout/stderr stream of a non-TTY exec from the raw
+  *sock* returned by `exec_start(socket=True)` and yields the payload of the
+  frames. Data is received into a preallocated buffer, large frames are
+  yielded in pieces of at most *bufsize* bytes. The socket's timeout is
+  disabled, and the socket is closed when the stream ends.
+  """
+
+  _disable_timeout(sock)
+  header = bytearray(8)
+  buffer = bytearray(bufsize)
+  view = memoryview(buffer)
+  try:
+    while _recv_exactly(sock, memoryview(header)) == len(header):
+      # 1 byte stream type, 3 bytes padding, 4 bytes big-endian length.
+      length = struct.unpack('>xxxxL', header)[0]
+      while length:
+        n = _recv_exactly(sock, view[:min(length, bufsize)])
+        if not n:
+          return
+        yield bytes(view[:n])
+        length -= n
+  finally:
+    sock.close()
+
+
 class ContainerExec(object):
 
   def __init__(self, client, id, output):
@@ -58,21 +149,38 @@ class ContainerExec(object):
   def poll(self):
     return self.inspect()['ExitCode']
 
-  def communicate(self, line_prefix=b''):
+  def communicate(self, line_prefix=b'', strip_ansi=False):
+    """
+    Writes the output of the exec to stdout, prefixing every line with
+    *line_prefix*, and returns the exit code. If *strip_ansi* is #True,
+    ANSI color and erase-in-line escape sequences are removed from the
+    output.
+    """
+
+    # Flush pending text before writing to the binary buffer directly. After
+    # that, only flush every chunk when someone is watching the output live.
+    sys.stdout.flush()
+    buffer = sys.stdout.buffer
+    tty = sys.stdout.isatty()
+    prefixed_nl = b'\n' + line_prefix
+    line_start = True
     for data in self.output:
+      if strip_ansi:
+        data = _ANSI.sub(b'', data)
       if not data: continue
-      offset = 0
-      while offset < len(data):
-        sys.stdout.buffer.write(line_prefix)
-        nl = data.find(b'\n', offset)
-        if nl >= 0:
-          slice = data[offset:nl+1]
-          offset = nl+1
-        else:
-          slice = data[offset:]
-          offset += len(slice)
-        sys.stdout.buffer.write(slice)
-      sys.stdout.flush()
-    while self.poll() is None:
-      raise RuntimeError('Hm could that really happen?')
-    return self.poll()
+      out = data.replace(b'\n', prefixed_nl)
+      if line_start:
+        out = line_prefix + out
+      # Hold back the prefix after a trailing newline until the next line
+      # actually starts, it may come in the next chunk.
+      line_start = out.endswith(prefixed_nl)
+      if line_start:
+        out = out[:len(out) - len(line_prefix)]
+      buffer.write(out)
+      if tty:
+        buffer.flush()
+    buffer.flush()
+    code = self.poll()
+    if code is None:
+      raise RuntimeError('exec still running after its output was drained')
+    return code
@@ -20,7 +20,130 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import contextlib
+import copy
+import errno
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+
 def merge_dictionary(a, b):
   a = a.copy()
   a.update(b)
   return a
+
+
+class PipeWriter(io.BufferedWriter):
+  """
+  A #io.BufferedWriter for the write end of a pipe. A pipe has no position,
+  but #tarfile.TarFile asks for it when it opens the archive, so #tell()
+  returns the number of bytes passed to #write() instead.
+  """
+
+  def __init__(self, raw, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    super(PipeWriter, self).__init__(raw, buffer_size)
+    self._written = 0
+
+  def write(self, data):
+    self._written += len(data)
+    return super(PipeWriter, self).write(data)
+
+  def tell(self):
+    return self._written
+
+
+@contextlib.contextmanager
+def gzip_writer(fp, compresslevel=1):
+  """
+  A context manager that yields a binary file object which compresses all
+  data written to it with gzip into the file *fp*. Uses `pigz` to compress
+  on multiple cores if it is installed, in which case *fp* must have a file
+  descriptor.
+  """
+
+  pigz = shutil.which('pigz')
+  if not pigz:
+    with gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=compresslevel) as gz:
+      yield gz
+    return
+
+  fp.flush()
+  proc = subprocess.Popen([pigz, '-{}'.format(compresslevel)],
+    stdin=subprocess.PIPE, stdout=fp, bufsize=0)
+  try:
+    with PipeWriter(proc.stdin, 1 << 20) as writer:
+      yield writer
+  finally:
+    proc.stdin.close()
+    code = proc.wait()
+  if code != 0:
+    raise subprocess.CalledProcessError(code, proc.args)
+
+
+def _fileno(fileobj):
+  if isinstance(fileobj, (io.FileIO, io.BufferedReader, io.BufferedWriter,
+                          io.BufferedRandom)):
+    return fileobj.fileno()
+  return None
+
+
+class TarFile(tarfile.TarFile):
+  """
+  A #tarfile.TarFile that copies the contents of files into the archive with
+  #os.sendfile() if both the file and the archive are plain files with a file
+  descriptor, avoiding to pass the data through Python. Falls back to the
+  default implementation otherwise, or if the platform does not support
+  #os.sendfile() between the two files.
+  """
+
+  def addfile(self, tarinfo, fileobj=None):
+    src_fd = _fileno(fileobj)
+    dst_fd = _fileno(self.fileobj)
+    if src_fd is None or dst_fd is None or not tarinfo.size or \
+        not hasattr(os, 'sendfile'):
+      return super(TarFile, self).addfile(tarinfo, fileobj)
+
+    self._check('awx')
+    tarinfo = copy.copy(tarinfo)
+
+    buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+    self.fileobj.write(buf)
+    self.offset += len(buf)
+    self.fileobj.flush()
+    seekable = self.fileobj.seekable()
+    if seekable:
+      end = self.fileobj.tell() + tarinfo.size
+
+    offset = fileobj.tell()
+    remaining = tarinfo.size
+    while remaining:
+      try:
+        sent = os.sendfile(dst_fd, src_fd, offset, remaining)
+      except OSError as exc:
+        if remaining != tarinfo.size or exc.errno not in (
+            errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+          raise
+        fileobj.seek(offset)
+        tarfile.copyfileobj(fileobj, self.fileobj, remaining,
+                            bufsize=self.copybufsize)
+        break
+      if sent == 0:
+        raise OSError('unexpected end of data')
+      offset += sent
+      remaining -= sent
+    else:
+      # Keep the position of the buffered archive file in sync with the
+      # file descriptor that #os.sendfile() wrote to.
+      if seekable:
+        self.fileobj.seek(end)
+
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+      self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+      blocks += 1
+    self.offset += blocks * tarfile.BLOCKSIZE
+    self.members.append(tarinfo)
@@ -12,5 +12,6 @@ setuptools.setup(
   license = 'MIT',
   description = 'A simplistic API for creating scripts that build Docker images.',
   packages = setuptools.find_packages(),
+  python_requires = '>=3.8',
   install_reqs = install_reqs
 )
@@ -0,0 +1,95 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from docker_image_builder import dockertools
+
+
+def _frame(data, stream=1):
+  return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class IterFramesTest(unittest.TestCase):
+
+  def test_frames_are_joined(self):
+    a, b = socket.socketpair()
+    b.sendall(_frame(b'hello ') + _frame(b'world\n', stream=2))
+    b.close()
+    self.assertEqual(b''.join(dockertools.iter_frames(a)), b'hello world\n')
+
+  def test_large_frames_are_split(self):
+    a, b = socket.socketpair()
+    b.sendall(_frame(b'x' * 100))
+    b.close()
+    chunks = list(dockertools.iter_frames(a, bufsize=30))
+    self.assertEqual(b''.join(chunks), b'x' * 100)
+    self.assertTrue(all(len(x) <= 30 for x in chunks))
+
+  def _check_silence(self, wrap):
+    a, b = socket.socketpair()
+    a.settimeout(0.2)
+    def write():
+      time.sleep(0.6)
+      b.sendall(_frame(b'done\n'))
+      b.close()
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+      self.assertEqual(b''.join(dockertools.iter_frames(wrap(a))), b'done\n')
+    finally:
+      thread.join()
+
+  def test_silence_longer_than_client_timeout(self):
+    self._check_silence(lambda sock: sock)
+
+  def test_silence_longer_than_client_timeout_socketio(self):
+    # docker-py returns a SocketIO for UNIX socket connections.
+    self._check_silence(lambda sock: socket.SocketIO(sock, 'rb'))
+
+
+class _FakeAPI(object):
+
+  def __init__(self, sock):
+    self.sock = sock
+
+  def exec_create(self, container_id, cmd, **kwargs):
+    return {'Id': 'exec'}
+
+  def exec_start(self, exec_id, socket=False):
+    assert socket
+    return self.sock
+
+  def exec_inspect(self, exec_id):
+    return {'ExitCode': 0}
+
+
+class _FakeContainer(object):
+
+  def __init__(self, sock):
+    self.id = 'container'
+    self.client = type('FakeClient', (), {'api': _FakeAPI(sock)})()
+
+
+class ContainerExecStreamTest(unittest.TestCase):
+
+  def test_silence_longer_than_client_timeout(self):
+    a, b = socket.socketpair()
+    a.settimeout(0.2)
+    def write():
+      time.sleep(0.6)
+      b.sendall(_frame(b'done\n'))
+      b.close()
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+      result = dockertools.container_exec_stream(_FakeContainer(a), ['true'])
+      self.assertEqual(b''.join(result.output), b'done\n')
+      self.assertEqual(result.poll(), 0)
+    finally:
+      thread.join()
+
+
+if __name__ == '__main__':
+  unittest.main()